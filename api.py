@@ -3,29 +3,48 @@ FastAPI backend for RAG Document Summarizer
 Handles file uploads, URL processing, and query processing
 """
 
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse, ORJSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field
 from typing import Optional, List
+import asyncio
+import json
 import os
-import tempfile
 import shutil
+import tempfile
+import aiofiles
+import aiofiles.tempfile
+import time
 import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from gtts import gTTS
+from piper import PiperVoice, SynthesisConfig
 import io
+import threading
+import wave
+import faiss
 
 from main import (
     RAGPipeline, 
     load_document, 
-    load_website,
+    aload_website,
+    aclose_http_clients,
+    build_faiss_index_with_embedding,
     build_retriever,
-    HuggingFaceEmbeddings,
+    get_embedding_model as get_shared_embedding_model,
+    MAX_NPROBE,
+    MAX_EF_SEARCH,
+    MAX_TOP_K,
     RecursiveCharacterTextSplitter
 )
 
-app = FastAPI(title="RAG Document Summarizer API", version="1.0.0")
+app = FastAPI(
+    title="RAG Document Summarizer API",
+    version="1.0.0",
+    default_response_class=ORJSONResponse  # orjson serializes large answers/snippets much faster
+)
 
 # CORS configuration
 app.add_middleware(
@@ -36,8 +55,117 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Per-session query micro-batchers, created on first query
+query_batchers = {}
+
+# Session limits: least recently used sessions are evicted past the limit,
+# and sessions idle for longer than the TTL expire
+MAX_ACTIVE_SESSIONS = 64
+SESSION_IDLE_TTL = 3600  # seconds
+
+# Each session's FAISS index is written here when the session is created. After
+# INDEX_IDLE_UNLOAD seconds without queries the in-memory copy is dropped, and the
+# next query maps it back from disk. Sessions don't outlive the process, so the
+# directory is private to it and removed on shutdown.
+INDEX_PARENT_DIR = os.environ.get("RAG_INDEX_DIR")
+if INDEX_PARENT_DIR:
+    os.makedirs(INDEX_PARENT_DIR, exist_ok=True)
+INDEX_DIR = tempfile.mkdtemp(prefix="rag-indexes-", dir=INDEX_PARENT_DIR)
+INDEX_IDLE_UNLOAD = 300  # seconds
+
+def session_index_path(session_id: str) -> str:
+    return os.path.join(INDEX_DIR, f"{session_id}.faiss")
+
+def save_session_index(session_id: str, rag):
+    faiss.write_index(rag.vectordb.index, session_index_path(session_id))
+
+def load_session_index(session_id: str, rag):
+    """
+    Map a session's index back from disk if it was unloaded.
+
+    IVF inverted lists are memory-mapped, so the OS pages in only the lists a
+    query touches; other index types are read into memory in full.
+    """
+    if rag.vectordb.index is None:
+        rag.vectordb.index = faiss.read_index(
+            session_index_path(session_id),
+            faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+        )
+
+class SessionStore:
+    """
+    Bounded LRU mapping of session ID -> RAGPipeline with an idle timeout.
+
+    Evicting a session stops its query batcher and drops the last references
+    to its pipeline, which frees the FAISS index's native memory.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()  # session_id -> (rag, last_used), oldest first
+
+    def _expire(self):
+        now = time.monotonic()
+        while self._items:
+            session_id, (_, last_used) = next(iter(self._items.items()))
+            if now - last_used < self.ttl:
+                break
+            self._evict(session_id)
+        # Drop idle indexes from memory; they are reloaded from disk on the next query
+        for rag, last_used in self._items.values():
+            if now - last_used >= INDEX_IDLE_UNLOAD and rag.vectordb is not None:
+                rag.vectordb.index = None
+
+    def _evict(self, session_id: str):
+        del self._items[session_id]
+        if session_id in query_batchers:
+            query_batchers.pop(session_id).close()
+        try:
+            os.unlink(session_index_path(session_id))
+        except FileNotFoundError:
+            pass
+
+    def __contains__(self, session_id: str):
+        self._expire()
+        return session_id in self._items
+
+    def __getitem__(self, session_id: str):
+        self._expire()
+        rag, _ = self._items[session_id]
+        self._items[session_id] = (rag, time.monotonic())
+        self._items.move_to_end(session_id)
+        return rag
+
+    def __setitem__(self, session_id: str, rag):
+        self._expire()
+        self._items[session_id] = (rag, time.monotonic())
+        self._items.move_to_end(session_id)
+        while len(self._items) > self.maxsize:
+            self._evict(next(iter(self._items)))
+
+    def __delitem__(self, session_id: str):
+        self._evict(session_id)
+
 # Global storage for active RAG pipelines (in production, use proper session management)
-active_pipelines = {}
+active_pipelines = SessionStore(maxsize=MAX_ACTIVE_SESSIONS, ttl=SESSION_IDLE_TTL)
+
+# Uploads are copied to disk in chunks of this size
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Document ingestion (splitting, embedding, index build) runs here instead of on
+# the event loop. Threads rather than processes: the embedding models and cache
+# are shared in memory, and torch releases the GIL during the forward pass.
+# A single worker: each embedding call already uses every core through torch's
+# intra-op pool, so concurrent ingests would only oversubscribe the CPU.
+INGEST_WORKERS = 1
+ingest_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest")
+
+@app.on_event("shutdown")
+async def shutdown_workers():
+    ingest_executor.shutdown(wait=False, cancel_futures=True)
+    await aclose_http_clients()
+    shutil.rmtree(INDEX_DIR, ignore_errors=True)
 
 # Request/Response models
 class QueryRequest(BaseModel):
@@ -45,7 +173,9 @@ class QueryRequest(BaseModel):
     llm_model: str = "mistral"
     embedding_model: str = "all-MiniLM-L6-v2"
     tone: str = "neutral"
-    top_k: int = 5
+    top_k: int = Field(default=5, gt=0, le=MAX_TOP_K)
+    nprobe: Optional[int] = Field(default=None, gt=0, le=MAX_NPROBE)  # IVF lists to visit (higher = better recall, slower)
+    ef_search: Optional[int] = Field(default=None, gt=0, le=MAX_EF_SEARCH)  # HNSW search depth (higher = better recall, slower)
 
 class QueryResponse(BaseModel):
     status: str
@@ -79,12 +209,104 @@ AVAILABLE_EMBEDDING_MODELS = {
 # Available LLM models
 AVAILABLE_LLM_MODELS = ["mistral", "llava"]
 
+# Query micro-batching: concurrent queries on a session are grouped so the
+# embedding model and FAISS run once on a (B, d) matrix instead of B times
+QUERY_BATCH_MAX_SIZE = 16
+QUERY_BATCH_MAX_WAIT = 0.005  # seconds
+
+class QueryBatcher:
+    """Collects concurrent queries for one session and retrieves them in batches"""
+
+    def __init__(self, rag):
+        self.rag = rag
+        self.queue = asyncio.Queue()
+        self.batch = []  # batch currently being retrieved
+        self.task = asyncio.create_task(self._run())
+
+    async def retrieve(self, question: str, top_k: int, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((question, top_k, (nprobe, ef_search), future))
+        return await future
+
+    async def _next_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + QUERY_BATCH_MAX_WAIT
+        while len(batch) < QUERY_BATCH_MAX_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            self.batch = batch = await self._next_batch()
+            # Queries with different search parameters can't share a FAISS search
+            groups = {}
+            for item in batch:
+                groups.setdefault(item[2], []).append(item)
+            for (nprobe, ef_search), group in groups.items():
+                questions = [question for question, _, _, _ in group]
+                top_ks = [k for _, k, _, _ in group]
+                try:
+                    results = await asyncio.to_thread(
+                        self.rag.retrieve_chunks_batch, questions, top_ks, nprobe=nprobe, ef_search=ef_search
+                    )
+                except Exception as e:
+                    for _, _, _, future in group:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for (_, _, _, future), chunks in zip(group, results):
+                    if not future.done():
+                        future.set_result(chunks)
+
+    def close(self):
+        """Stop the batcher; queries still waiting on it fail with 404"""
+        self.task.cancel()
+        pending = list(self.batch)
+        while not self.queue.empty():
+            pending.append(self.queue.get_nowait())
+        for _, _, _, future in pending:
+            if not future.done():
+                future.set_exception(HTTPException(status_code=404, detail="Session not found"))
+
+def get_query_batcher(session_id: str, rag):
+    """Get (or start) the query batcher for a session"""
+    if session_id not in query_batchers:
+        query_batchers[session_id] = QueryBatcher(rag)
+    return query_batchers[session_id]
+
 def get_embedding_model(model_name: str):
-    """Get embedding model by name"""
+    """Get embedding model by name (shared across sessions)"""
     if model_name not in AVAILABLE_EMBEDDING_MODELS:
         raise ValueError(f"Embedding model '{model_name}' not supported. Available: {list(AVAILABLE_EMBEDDING_MODELS.keys())}")
     
-    return HuggingFaceEmbeddings(model_name=AVAILABLE_EMBEDDING_MODELS[model_name])
+    return get_shared_embedding_model(AVAILABLE_EMBEDDING_MODELS[model_name])
+
+def build_pipeline(docs, llm_model: str, embedding_model_name: str):
+    """Split, embed and index documents into a ready-to-query RAG pipeline"""
+    embedding = get_embedding_model(embedding_model_name)
+    
+    # Build FAISS index
+    chunks = splitter.split_documents(docs)
+    vectordb = build_faiss_index_with_embedding(chunks, embedding)
+    retriever = build_retriever(vectordb)
+    
+    # Create RAG pipeline with the selected embedding model
+    rag = RAGPipeline(model_name=llm_model, embedding_model_name=embedding_model_name)
+    rag.vectordb = vectordb
+    rag.retriever = retriever
+    return rag
+
+async def run_ingest(docs, llm_model: str, embedding_model_name: str):
+    """Run build_pipeline on the ingestion executor"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(ingest_executor, build_pipeline, docs, llm_model, embedding_model_name)
 
 @app.get("/")
 async def root():
@@ -118,15 +340,16 @@ async def upload_file(
         if not file.filename.endswith(('.pdf', '.docx', '.txt')):
             raise HTTPException(status_code=400, detail="Unsupported file type. Only PDF, DOCX, and TXT files are supported.")
         
-        # Save uploaded file temporarily
-        with tempfile.NamedTemporaryFile(delete=False, suffix=Path(file.filename).suffix) as tmp_file:
-            shutil.copyfileobj(file.file, tmp_file)
+        # Save uploaded file temporarily, streaming it in large chunks off the event loop
+        async with aiofiles.tempfile.NamedTemporaryFile("wb", delete=False, suffix=Path(file.filename).suffix) as tmp_file:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                await tmp_file.write(chunk)
             tmp_path = tmp_file.name
         
         try:
             # Load document with better error handling
             try:
-                docs = load_document(tmp_path)
+                docs = await asyncio.to_thread(load_document, tmp_path)
             except Exception as doc_error:
                 error_msg = str(doc_error)
                 # Check for specific PDF errors
@@ -146,21 +369,12 @@ async def upload_file(
                         detail=f"Error reading document: {error_msg}"
                     )
             
-            # Create embedding model
-            embedding = get_embedding_model(embedding_model)
+            # Embed and index the document off the event loop
+            rag = await run_ingest(docs, llm_model, embedding_model)
             
-            # Build FAISS index
-            chunks = splitter.split_documents(docs)
-            vectordb = build_faiss_index_with_embedding(chunks, embedding)
-            retriever = build_retriever(vectordb)
-            
-            # Create RAG pipeline with the selected embedding model
-            rag = RAGPipeline(model_name=llm_model, embedding_model_name=embedding_model)
-            rag.vectordb = vectordb
-            rag.retriever = retriever
-            
-            # Generate session ID
+            # Generate session ID and persist the index for later reloads
             session_id = str(uuid.uuid4())
+            await asyncio.to_thread(save_session_index, session_id, rag)
             active_pipelines[session_id] = rag
             
             return {
@@ -191,62 +405,100 @@ async def process_url(request: URLProcessRequest):
             raise HTTPException(status_code=400, detail="Invalid URL. Must start with http:// or https://")
         
         # Load website content
-        docs = load_website(request.url)
-        
-        # Create embedding model
-        embedding = get_embedding_model(request.embedding_model)
+        docs = await aload_website(request.url)
         
-        # Build FAISS index
-        chunks = splitter.split_documents(docs)
-        vectordb = build_faiss_index_with_embedding(chunks, embedding)
-        retriever = build_retriever(vectordb)
+        # Embed and index the page off the event loop
+        rag = await run_ingest(docs, request.llm_model, request.embedding_model)
         
-        # Create RAG pipeline with the selected embedding model
-        rag = RAGPipeline(model_name=request.llm_model, embedding_model_name=request.embedding_model)
-        rag.vectordb = vectordb
-        rag.retriever = retriever
-        
-        # Generate session ID
+        # Generate session ID and persist the index for later reloads
         session_id = str(uuid.uuid4())
+        await asyncio.to_thread(save_session_index, session_id, rag)
         active_pipelines[session_id] = rag
         
-        return URLProcessResponse(
-            status="success",
-            session_id=session_id,
-            message="URL processed successfully"
-        )
+        return {
+            "status": "success",
+            "session_id": session_id,
+            "message": "URL processed successfully"
+        }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing URL: {str(e)}")
 
 @app.post("/query/{session_id}", response_model=QueryResponse)
 async def query_document(
     session_id: str,
-    request: QueryRequest
+    request: QueryRequest,
+    http_request: Request
 ):
     """
     Query a document using an existing session
+
+    Clients sending `Accept: text/event-stream` get the answer streamed as
+    server-sent events: a `context` event with the snippets, one `data`
+    event per answer piece, then a `done` event.
     """
     if session_id not in active_pipelines:
         raise HTTPException(status_code=404, detail="Session not found. Please upload a file or process a URL first.")
     
     try:
         rag = active_pipelines[session_id]
-        
-        # Retrieve relevant chunks
-        chunks = rag.retrieve_chunks(request.question, request.top_k)
+        try:
+            await asyncio.to_thread(load_session_index, session_id, rag)
+        except FileNotFoundError:
+            if session_id in active_pipelines:
+                raise
+        # The session may have been evicted (and its index file removed) while
+        # the index was loading; don't start a batcher for it again
+        if session_id not in active_pipelines:
+            raise HTTPException(status_code=404, detail="Session not found. Please upload a file or process a URL first.")
+
+        # Retrieve relevant chunks (batched with concurrent queries on this session);
+        # nprobe / ef_search tune the recall/latency tradeoff for this query only
+        chunks = await get_query_batcher(session_id, rag).retrieve(
+            request.question, request.top_k, nprobe=request.nprobe, ef_search=request.ef_search
+        )
         context_snippets = [chunk.page_content for chunk in chunks]
         
-        # Generate answer
-        answer = rag.generate_answer(request.question, request.tone, request.top_k)
+        if "text/event-stream" in http_request.headers.get("accept", ""):
+            return StreamingResponse(
+                stream_answer(rag, request, chunks, context_snippets),
+                media_type="text/event-stream"
+            )
         
-        return QueryResponse(
-            status="success",
-            answer=answer,
-            context_snippets=context_snippets
-        )
+        # Generate answer from the chunks retrieved above (off the event loop)
+        answer = await asyncio.to_thread(rag.generate_answer, request.question, request.tone, request.top_k, chunks=chunks)
+        
+        # Returned as a response directly: server-built data doesn't need response_model validation
+        return ORJSONResponse(content={
+            "status": "success",
+            "answer": answer,
+            "context_snippets": context_snippets
+        })
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating answer: {str(e)}")
 
+def _sse(data, event: Optional[str] = None) -> str:
+    """Format one server-sent event with a JSON payload"""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+def stream_answer(rag, request: QueryRequest, chunks, context_snippets):
+    """
+    Yield the answer as server-sent events.
+
+    This is a sync generator, so StreamingResponse iterates it in a worker
+    thread and the blocking Ollama stream never runs on the event loop.
+    """
+    yield _sse({"context_snippets": context_snippets}, event="context")
+    try:
+        for token in rag.generate_answer_stream(request.question, request.tone, request.top_k, chunks=chunks):
+            yield _sse({"token": token})
+    except Exception as e:
+        yield _sse({"message": f"Error generating answer: {str(e)}"}, event="error")
+        return
+    yield _sse({}, event="done")
+
 @app.delete("/session/{session_id}")
 async def delete_session(session_id: str):
     """
@@ -260,50 +512,67 @@ async def delete_session(session_id: str):
 
 class TTSRequest(BaseModel):
     text: str
-    lang: str = "en"  # Language code (e.g., 'en', 'es', 'fr', etc.)
+    lang: str = "en"  # Language code; must have a voice in PIPER_VOICES
     slow: bool = False  # Slow down speech
 
+# Local Piper voices (ONNX models) by language code. English is built in; any
+# other language is enabled by pointing PIPER_VOICE_<LANG> (e.g. PIPER_VOICE_DE)
+# at a downloaded voice model.
+PIPER_VOICE_ENV_PREFIX = "PIPER_VOICE_"
+PIPER_VOICES = {"en": "en_US-lessac-medium.onnx"}
+PIPER_VOICES.update({
+    name[len(PIPER_VOICE_ENV_PREFIX):].lower(): path
+    for name, path in os.environ.items()
+    if name.startswith(PIPER_VOICE_ENV_PREFIX) and len(name) > len(PIPER_VOICE_ENV_PREFIX) and path
+})
+SLOW_SPEECH_LENGTH_SCALE = 1.5  # phoneme length multiplier for slow speech
+
+# Voices are loaded once, on first use, and shared by all requests
+tts_voices = {}
+tts_voices_lock = threading.Lock()
+
+def get_tts_voice(lang: str):
+    """Get the Piper voice for a language, loading it on first use"""
+    with tts_voices_lock:
+        if lang not in tts_voices:
+            tts_voices[lang] = PiperVoice.load(PIPER_VOICES[lang])
+        return tts_voices[lang]
+
+def synthesize_speech(text: str, lang: str, slow: bool) -> bytes:
+    """Synthesize speech in-process and return it as WAV bytes"""
+    voice = get_tts_voice(lang)
+    syn_config = SynthesisConfig(length_scale=SLOW_SPEECH_LENGTH_SCALE if slow else None)
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav_file:
+        voice.synthesize_wav(text, wav_file, syn_config=syn_config)
+    return buffer.getvalue()
+
 @app.post("/tts")
 async def text_to_speech(request: TTSRequest):
     """
-    Convert text to speech using gTTS
-    Returns an MP3 audio file
+    Convert text to speech with a local Piper voice
+    Returns a WAV audio file
     """
     try:
-        # Limit text length to prevent abuse (gTTS has limits)
+        # Limit text length to bound synthesis time
         if len(request.text) > 5000:
             raise HTTPException(status_code=400, detail="Text too long. Maximum 5000 characters.")
+        if request.lang not in PIPER_VOICES:
+            raise HTTPException(status_code=400, detail=f"Language '{request.lang}' not supported. Available: {list(PIPER_VOICES.keys())}")
         
-        # Create gTTS object
-        tts = gTTS(text=request.text, lang=request.lang, slow=request.slow)
+        # Synthesis is CPU-bound, so keep it off the event loop
+        audio = await asyncio.to_thread(synthesize_speech, request.text, request.lang, request.slow)
         
-        # Save to temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as tmp_file:
-            tts.save(tmp_file.name)
-            tmp_path = tmp_file.name
-        
-        # Return the audio file with cleanup
-        def cleanup():
-            try:
-                if os.path.exists(tmp_path):
-                    os.unlink(tmp_path)
-            except:
-                pass
-        
-        return FileResponse(
-            tmp_path,
-            media_type="audio/mpeg",
-            filename="speech.mp3",
-            background=cleanup
+        return Response(
+            content=audio,
+            media_type="audio/wav",
+            headers={"Content-Disposition": 'attachment; filename="speech.wav"'}
         )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating speech: {str(e)}")
 
-def build_faiss_index_with_embedding(docs, embedding_model):
-    """Build FAISS index with a specific embedding model"""
-    from langchain_community.vectorstores import FAISS
-    return FAISS.from_documents(docs, embedding_model)
-
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
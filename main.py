@@ -1,14 +1,32 @@
 # -----------------------------
 # Install dependencies if not done
 # -----------------------------
-# pip install faiss-cpu sentence-transformers beautifulsoup4 requests python-docx pypdf ollama
+# pip install faiss-cpu numpy numba datasketch torch sentence-transformers selectolax requests httpx[http2] orjson python-docx pypdf ollama
 
 import ollama
 import os
-from bs4 import BeautifulSoup
+import re
+import math
+import uuid
+import hashlib
+import importlib.util
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Optional
+import numpy as np
+import faiss
+import torch
+from numba import njit
+import asyncio
+from selectolax.lexbor import LexborHTMLParser
 import requests
+import httpx
+from datasketch import MinHash, MinHashLSH, LeanMinHash
 
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader, TextLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
@@ -21,12 +39,16 @@ from langchain_core.documents import Document
 class PromptTemplate:
     def __init__(self, template: str):
         self.template = template
+        # Alternating literal text and placeholder names: [text, name, text, name, ..., text]
+        self._segments = re.split(r"\{(\w+)\}", template)
 
     def format(self, **kwargs):
-        formatted = self.template
-        for key, value in kwargs.items():
-            formatted = formatted.replace("{" + key + "}", value)
-        return formatted
+        # Single pass over the template; unknown placeholders are left as-is
+        parts = list(self._segments)
+        for i in range(1, len(parts), 2):
+            name = parts[i]
+            parts[i] = kwargs[name] if name in kwargs else "{" + name + "}"
+        return "".join(parts)
 
 
 # Default template
@@ -74,10 +96,76 @@ def load_document(file_path):
         # Re-raise with more context
         raise Exception(f"Failed to load document '{file_path}': {str(e)}")
 
+# Pages are truncated past this size to bound download and parsing work
+MAX_WEBSITE_BYTES = 5 << 20
+WEBSITE_CHUNK_SIZE = 64 << 10
+HTTP_TIMEOUT = 30.0
+
+# Shared HTTP clients: repeated fetches from the same host reuse open
+# connections instead of paying a new TCP + TLS handshake each time. The async
+# client speaks HTTP/2 when the optional h2 package is installed.
+http_session = requests.Session()
+_async_http_client = None
+
+def get_async_http_client():
+    """Get the shared async HTTP client, creating it on first use"""
+    global _async_http_client
+    if _async_http_client is None:
+        _async_http_client = httpx.AsyncClient(
+            http2=importlib.util.find_spec("h2") is not None,
+            timeout=HTTP_TIMEOUT,
+            follow_redirects=True,
+            limits=httpx.Limits(max_keepalive_connections=32)
+        )
+    return _async_http_client
+
+async def aclose_http_clients():
+    """Close the shared HTTP clients (call on application shutdown)"""
+    global _async_http_client
+    http_session.close()
+    if _async_http_client is not None:
+        await _async_http_client.aclose()
+        _async_http_client = None
+
+class _CappedBody:
+    """Accumulates a response body up to MAX_WEBSITE_BYTES"""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def add(self, chunk) -> bool:
+        """Append a chunk; returns False once the cap is reached"""
+        self.data += chunk
+        return len(self.data) < MAX_WEBSITE_BYTES
+
+    def decode(self, encoding) -> str:
+        return self.data[:MAX_WEBSITE_BYTES].decode(encoding or "utf-8", errors="replace")
+
 def load_website(url):
-    html = requests.get(url).text
-    soup = BeautifulSoup(html, "html.parser")
-    text = soup.get_text()
+    with http_session.get(url, stream=True, timeout=HTTP_TIMEOUT) as response:
+        body = _CappedBody()
+        for chunk in response.iter_content(chunk_size=WEBSITE_CHUNK_SIZE):
+            if not body.add(chunk):
+                break
+        html = body.decode(response.encoding)
+    return _html_to_documents(html, url)
+
+async def aload_website(url):
+    """Async version of load_website: fetches without blocking and parses in a worker thread"""
+    async with get_async_http_client().stream("GET", url) as response:
+        body = _CappedBody()
+        async for chunk in response.aiter_bytes(WEBSITE_CHUNK_SIZE):
+            if not body.add(chunk):
+                break
+        html = body.decode(response.encoding)
+    return await asyncio.to_thread(_html_to_documents, html, url)
+
+def _html_to_documents(html, url):
+    tree = LexborHTMLParser(html)
+    for tag in tree.css("script, style, noscript"):
+        tag.decompose()
+    root = tree.body or tree.root
+    text = root.text(separator=" ") if root is not None else ""
     return [Document(page_content=text, metadata={"source": url})]  # same format as document loader
 
 
@@ -95,7 +183,441 @@ splitter = RecursiveCharacterTextSplitter(
 # 4. FAISS + Embeddings
 # -----------------------------
 
-embedding_model = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
+# Let the embedding forward pass use every core
+torch.set_num_threads(os.cpu_count() or 1)
+
+EMBED_BATCH_SIZE = 64
+
+# Embedding model weight dtype: "float32", "bfloat16", or "auto" (bfloat16 when
+# the hardware has native BF16 matmul, e.g. AMX / AVX512-BF16 or a recent GPU)
+EMBEDDING_DTYPE = os.environ.get("RAG_EMBEDDING_DTYPE", "auto")
+
+def _has_native_bf16():
+    if torch.cuda.is_available():
+        return torch.cuda.is_bf16_supported()
+    try:
+        with open("/proc/cpuinfo") as f:
+            cpu_flags = f.read()
+    except OSError:
+        return False
+    return "amx_bf16" in cpu_flags or "avx512_bf16" in cpu_flags
+
+# Compile the transformer with torch.compile (slow first call per input shape,
+# faster afterwards); inputs are padded to fixed lengths so compiled graphs are reused
+TORCH_COMPILE = os.environ.get("RAG_TORCH_COMPILE", "0") == "1"
+SEQ_LEN_BUCKETS = (128, 256, 512)
+
+def _pad_to_buckets(transformer):
+    """Make a SentenceTransformer Transformer module pad token batches to a bucket length"""
+    buckets = [b for b in SEQ_LEN_BUCKETS if b < transformer.max_seq_length] + [transformer.max_seq_length]
+    pad_token_id = transformer.tokenizer.pad_token_id or 0
+    tokenize = transformer.tokenize
+
+    def bucketed_tokenize(texts, *args, **kwargs):
+        features = tokenize(texts, *args, **kwargs)
+        seq_len = features["input_ids"].shape[1]
+        pad = next((b for b in buckets if b >= seq_len), seq_len) - seq_len
+        if pad:
+            for name, tensor in features.items():
+                if tensor.dim() == 2:
+                    # Padded positions are masked out, so pooling is unchanged
+                    value = pad_token_id if name == "input_ids" else 0
+                    features[name] = torch.nn.functional.pad(tensor, (0, pad), value=value)
+        return features
+
+    transformer.tokenize = bucketed_tokenize
+
+BATCH_BUCKETS = tuple(b for b in (1, 4, 16) if b < EMBED_BATCH_SIZE) + (EMBED_BATCH_SIZE,)
+
+def _slice_batch(output, batch_size):
+    """Drop padding rows from a model output (ModelOutput, tuple or tensor)"""
+    if isinstance(output, torch.Tensor):
+        return output[:batch_size]
+    if isinstance(output, dict):
+        for name, value in output.items():
+            output[name] = _slice_batch(value, batch_size)
+        return output
+    if isinstance(output, (tuple, list)):
+        return type(output)(_slice_batch(value, batch_size) for value in output)
+    return output
+
+class _BatchBucketed(torch.nn.Module):
+    """
+    Pad the batch dimension of a compiled model's inputs to a bucket size.
+
+    With dynamic=False every distinct batch size would trigger a recompile;
+    padding the (usually smaller) final batch of an encode call or a query
+    batch keeps the number of graphs to len(BATCH_BUCKETS) per sequence bucket.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        self.config = model.config
+
+    def forward(self, **features):
+        batch_size = features["input_ids"].shape[0]
+        pad = next((b for b in BATCH_BUCKETS if b >= batch_size), batch_size) - batch_size
+        if pad:
+            for name, tensor in features.items():
+                if isinstance(tensor, torch.Tensor) and tensor.dim() >= 1 and tensor.shape[0] == batch_size:
+                    # Repeat the last row; an all-masked padding row could produce NaNs
+                    features[name] = torch.cat([tensor, tensor[-1:].expand(pad, *tensor.shape[1:])])
+        return _slice_batch(self.model(**features), batch_size)
+
+def load_embedding_model(model_name):
+    """Load a HuggingFace embedding model, cast to EMBEDDING_DTYPE and optionally compiled"""
+    hf = HuggingFaceEmbeddings(model_name=model_name)
+    if EMBEDDING_DTYPE == "bfloat16" or (EMBEDDING_DTYPE == "auto" and _has_native_bf16()):
+        # SentenceTransformer.encode upcasts BF16 outputs before converting to numpy
+        hf.client.to(torch.bfloat16)
+    if TORCH_COMPILE:
+        transformer = hf.client[0]
+        _pad_to_buckets(transformer)
+        # One graph per (batch bucket, sequence bucket) pair must fit in dynamo's cache
+        dynamo_config = torch._dynamo.config
+        limit = "recompile_limit" if hasattr(dynamo_config, "recompile_limit") else "cache_size_limit"
+        setattr(dynamo_config, limit, max(getattr(dynamo_config, limit), len(BATCH_BUCKETS) * (len(SEQ_LEN_BUCKETS) + 1)))
+        compiled = torch.compile(transformer.auto_model, mode="reduce-overhead", dynamic=False)
+        transformer.auto_model = _BatchBucketed(compiled)
+    return hf
+
+# Loaded embedding models by name. Models are read-only after loading, so one
+# instance is safely shared by every pipeline and thread.
+_EMBED_REGISTRY = {}  # model name -> HuggingFaceEmbeddings
+_EMBED_REGISTRY_LOCK = threading.Lock()
+
+def get_embedding_model(model_name):
+    """Get the shared embedding model for `model_name`, loading it on first use"""
+    with _EMBED_REGISTRY_LOCK:
+        if model_name not in _EMBED_REGISTRY:
+            _EMBED_REGISTRY[model_name] = load_embedding_model(model_name)
+        return _EMBED_REGISTRY[model_name]
+
+embedding_model = get_embedding_model("all-MiniLM-L6-v2")
+
+def encode_texts(embedding_model_instance, texts, normalize: bool = True):
+    """
+    Embed texts with the underlying SentenceTransformer in padded batches.
+
+    Returns a float32 array directly instead of going through
+    HuggingFaceEmbeddings.embed_documents, which converts to nested lists.
+    """
+    vectors = embedding_model_instance.client.encode(
+        list(texts),
+        batch_size=EMBED_BATCH_SIZE,
+        convert_to_numpy=True,
+        normalize_embeddings=normalize,
+        show_progress_bar=False
+    )
+    return vectors.astype(np.float32, copy=False)
+
+EMBEDDING_CACHE_PATH = os.environ.get(
+    "RAG_EMBEDDING_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "rag", "embeddings.sqlite3")
+)
+
+# Near-duplicate lookup: chunks whose 5-char shingle sets are >= 95% similar
+# (whitespace / page-number artifacts) reuse each other's embeddings
+MINHASH_NUM_PERM = 128
+MINHASH_THRESHOLD = 0.95
+MINHASH_SHINGLE_SIZE = 5
+# Signatures kept in memory per namespace (most recently added first); each
+# costs ~2.3 KB, older ones stay on disk but are no longer matched
+MINHASH_LSH_MAX_ENTRIES = 20_000
+
+# Bump when the stored vectors change meaning (currently: unit-normalized
+# encoder output) so old entries are no longer matched
+EMBEDDING_CACHE_VERSION = "normalized-v1"
+
+class EmbeddingCache:
+    """
+    Persistent chunk embedding cache backed by SQLite.
+
+    Vectors are stored as float32 blobs keyed by SHA-256(namespace + text),
+    where the namespace is the model name, its weight dtype and
+    EMBEDDING_CACHE_VERSION, so a chunk is only embedded once per model
+    configuration, across sessions and restarts.
+    On an exact miss, a MinHash LSH index over the cached chunks is queried
+    so near-duplicate chunks reuse an existing vector; it holds only the
+    MINHASH_LSH_MAX_ENTRIES most recent signatures per namespace.
+    """
+    _BATCH = 500  # stay under SQLite's bound-parameter limit
+
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lsh = {}  # namespace -> (MinHashLSH, OrderedDict {key: LeanMinHash}, oldest first)
+        self._lsh_load_lock = threading.Lock()
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS minhashes (key BLOB PRIMARY KEY, model TEXT NOT NULL, signature BLOB NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS minhashes_model ON minhashes (model)")
+
+    @staticmethod
+    def _namespace(embedding_model_instance) -> str:
+        """Cache namespace: vectors differ by model, weight dtype and normalization"""
+        dtype = next(embedding_model_instance.client.parameters()).dtype
+        return f"{embedding_model_instance.model_name}|{dtype}|{EMBEDDING_CACHE_VERSION}"
+
+    @staticmethod
+    def _key(namespace: str, text: str) -> bytes:
+        return hashlib.sha256((namespace + "\0" + text).encode()).digest()
+
+    @staticmethod
+    def _minhash(text: str) -> LeanMinHash:
+        text = " ".join(text.split())
+        shingles = {text[i:i + MINHASH_SHINGLE_SIZE] for i in range(max(len(text) - MINHASH_SHINGLE_SIZE + 1, 1))}
+        minhash = MinHash(num_perm=MINHASH_NUM_PERM)
+        minhash.update_batch([shingle.encode() for shingle in shingles])
+        return LeanMinHash(minhash)
+
+    def _model_lsh(self, namespace: str):
+        """
+        Get the LSH index for a namespace, loading its most recent signatures on first use.
+
+        Loading reads through its own connection without the cache lock, so
+        lookups and writes from other threads aren't blocked meanwhile.
+        """
+        entry = self._lsh.get(namespace)
+        if entry is not None:
+            return entry
+        with self._lsh_load_lock:
+            if namespace not in self._lsh:
+                conn = sqlite3.connect(self._path)
+                try:
+                    rows = conn.execute(
+                        "SELECT key, signature FROM minhashes WHERE model = ? ORDER BY rowid DESC LIMIT ?",
+                        (namespace, MINHASH_LSH_MAX_ENTRIES)
+                    ).fetchall()
+                finally:
+                    conn.close()
+                lsh = MinHashLSH(threshold=MINHASH_THRESHOLD, num_perm=MINHASH_NUM_PERM)
+                signatures = OrderedDict()
+                for key, blob in reversed(rows):
+                    signatures[key] = LeanMinHash.deserialize(blob)
+                    lsh.insert(key, signatures[key])
+                self._lsh[namespace] = (lsh, signatures)
+        return self._lsh[namespace]
+
+    def _find_near_duplicate(self, namespace: str, signature: LeanMinHash):
+        lsh, signatures = self._model_lsh(namespace)
+        with self._lock:
+            candidates = [(signatures[key].jaccard(signature), key) for key in lsh.query(signature)]
+        if not candidates:
+            return None
+        similarity, key = max(candidates)
+        return key if similarity >= MINHASH_THRESHOLD else None
+
+    def _add_signatures(self, namespace: str, items):
+        lsh, signatures = self._model_lsh(namespace)
+        with self._lock, self._conn:
+            for key, signature in items:
+                if key in signatures:
+                    signatures.move_to_end(key)
+                else:
+                    lsh.insert(key, signature)
+                    signatures[key] = signature
+            while len(signatures) > MINHASH_LSH_MAX_ENTRIES:
+                key, _ = signatures.popitem(last=False)
+                lsh.remove(key)
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO minhashes (key, model, signature) VALUES (?, ?, ?)",
+                [(key, namespace, self._serialize(signature)) for key, signature in items]
+            )
+
+    @staticmethod
+    def _serialize(signature: LeanMinHash) -> bytes:
+        buf = bytearray(signature.bytesize())
+        signature.serialize(buf)
+        return bytes(buf)
+
+    def _get_many(self, keys):
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), self._BATCH):
+                batch = keys[start:start + self._BATCH]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                    batch
+                )
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def _put_many(self, items):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, vector.tobytes()) for key, vector in items]
+            )
+
+    def embed_documents(self, embedding_model_instance, texts):
+        """
+        Embed texts, reusing cached vectors and embedding only the misses
+
+        Returns:
+            np.ndarray: float32 array of shape (len(texts), dim)
+        """
+        namespace = self._namespace(embedding_model_instance)
+        keys = [self._key(namespace, text) for text in texts]
+        cached = self._get_many(keys)
+
+        # Exact misses: look for a near-duplicate chunk before embedding
+        signatures = {}
+        near_duplicates = {}
+        for key, text in zip(keys, texts):
+            if key in cached or key in signatures:
+                continue
+            signatures[key] = self._minhash(text)
+            match = self._find_near_duplicate(namespace, signatures[key])
+            if match is not None:
+                near_duplicates[key] = match
+        new_items = []
+        if near_duplicates:
+            matched_vectors = self._get_many(list(set(near_duplicates.values())))
+            for key, match in near_duplicates.items():
+                if match in matched_vectors:
+                    new_items.append((key, matched_vectors[match]))
+
+        reused = {key for key, _ in new_items}
+        missing = {key: text for key, text in zip(keys, texts) if key in signatures and key not in reused}
+        if missing:
+            new_vectors = encode_texts(embedding_model_instance, missing.values())
+            new_items.extend(zip(missing, new_vectors))
+
+        if new_items:
+            self._put_many(new_items)
+            cached.update(new_items)
+        if missing:
+            # Only chunks that were actually encoded become match targets; indexing
+            # reused chunks too would let matches chain past MINHASH_THRESHOLD
+            self._add_signatures(namespace, [(key, signatures[key]) for key in missing])
+
+        if missing and len(missing) == len(keys):
+            # Cold ingest: the encoder output is already one contiguous float32 array in order
+            return new_vectors
+        # Otherwise assemble rows into a single preallocated buffer FAISS can add without copying
+        xb = np.empty((len(keys), embedding_model_instance.client.get_sentence_embedding_dimension()), dtype=np.float32)
+        for row, key in enumerate(keys):
+            xb[row] = cached[key]
+        return xb
+
+
+embedding_cache = EmbeddingCache()
+
+# FAISS index settings
+# IVF needs enough vectors to train its centroids and PQ codebooks; below this
+# we use HNSW over FP16 scalar-quantized vectors. The SQfp16 codec is shared by
+# ingest and query, and Faiss fuses the fp16 decode into its SIMD distance
+# kernels (AVX2/NEON), so scans move half the bytes of raw FP32 storage.
+PQ_BITS = 8
+IVF_MIN_TRAINING_VECTORS = 39 * (1 << PQ_BITS)  # k-means wants ~39 points per PQ centroid
+DEFAULT_NPROBE = 8
+DEFAULT_EF_SEARCH = 64
+# Upper bounds for per-query overrides: efSearch sizes the HNSW candidate heap,
+# so unbounded values let a single query allocate arbitrary memory
+MAX_NPROBE = 1024
+MAX_EF_SEARCH = 1024
+# Chunks returned per query: bounds the MMR candidate pool (and its n x n
+# similarity matrix) and the number of chunks placed in the LLM prompt
+MAX_TOP_K = 20
+
+def _faiss_index_spec(dim: int, num_vectors: int) -> str:
+    """Pick an index_factory string for the given collection size"""
+    if num_vectors < IVF_MIN_TRAINING_VECTORS:
+        return "HNSW32,SQfp16"
+    # ~4*sqrt(n) lists, with at least 39 training points per centroid
+    nlist = min(int(4 * math.sqrt(num_vectors)), num_vectors // 39)
+    # Largest sub-quantizer count (<= dim/4) that divides the dimension
+    m = next(m for m in range(dim // 4, 0, -1) if dim % m == 0)
+    return f"IVF{nlist}_HNSW32,PQ{m}x{PQ_BITS}"
+
+def set_search_params(index, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+    """Set nprobe / efSearch on a FAISS index, ignoring parameters it doesn't have"""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        if ef_search is not None:
+            index.hnsw.efSearch = ef_search
+        return
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is None:
+        return
+    if nprobe is not None:
+        ivf.nprobe = nprobe
+    if ef_search is not None:
+        quantizer = faiss.downcast_index(ivf.quantizer)
+        if isinstance(quantizer, faiss.IndexHNSW):
+            quantizer.hnsw.efSearch = ef_search
+
+def search_parameters(index, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+    """
+    Build per-search FAISS parameters overriding nprobe / efSearch.
+
+    Unset values fall back to the index's own settings; given values are
+    capped at MAX_NPROBE / MAX_EF_SEARCH. Returns None when nothing is
+    overridden or the index has neither parameter. The index itself is not
+    modified, so concurrent searches don't affect each other.
+    """
+    if nprobe is None and ef_search is None:
+        return None
+    if nprobe is not None:
+        nprobe = min(nprobe, MAX_NPROBE)
+    if ef_search is not None:
+        ef_search = min(ef_search, MAX_EF_SEARCH)
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(efSearch=ef_search) if ef_search is not None else None
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is None:
+        return None
+    params = faiss.SearchParametersIVF(nprobe=nprobe if nprobe is not None else ivf.nprobe)
+    quantizer = faiss.downcast_index(ivf.quantizer)
+    if isinstance(quantizer, faiss.IndexHNSW):
+        quantizer_params = faiss.SearchParametersHNSW(
+            efSearch=ef_search if ef_search is not None else quantizer.hnsw.efSearch
+        )
+        params.quantizer_params = quantizer_params
+        params.referenced_objects = [quantizer_params]  # keep the nested params alive
+    return params
+
+def build_faiss_index_with_embedding(docs, embedding_model_instance):
+    """
+    Build FAISS index over already-split chunks with a specific embedding model
+
+    Vectors are unit-normalized and searched by inner product, which ranks
+    exactly like cosine similarity (what sentence-transformers are trained
+    for) and uses Faiss's inner-product distance kernels.
+    """
+    texts = [doc.page_content for doc in docs]
+    xb = embedding_cache.embed_documents(embedding_model_instance, texts)  # already unit-normalized
+    num_vectors, dim = xb.shape
+
+    index = faiss.index_factory(dim, _faiss_index_spec(dim, num_vectors), faiss.METRIC_INNER_PRODUCT)
+    if not index.is_trained:
+        index.train(xb)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        # MMR reconstructs candidate vectors by id
+        ivf.make_direct_map()
+    index.add(xb)
+    set_search_params(index, nprobe=DEFAULT_NPROBE, ef_search=DEFAULT_EF_SEARCH)
+
+    ids = [str(uuid.uuid4()) for _ in docs]
+    return FAISS(
+        embedding_function=embedding_model_instance,
+        index=index,
+        docstore=InMemoryDocstore(dict(zip(ids, docs))),
+        index_to_docstore_id=dict(enumerate(ids)),
+        normalize_L2=True,
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+    )
 
 def build_faiss_index(docs, embedding_model_instance=None):
     """
@@ -108,7 +630,7 @@ def build_faiss_index(docs, embedding_model_instance=None):
     if embedding_model_instance is None:
         embedding_model_instance = embedding_model
     chunks = splitter.split_documents(docs)
-    vectordb = FAISS.from_documents(chunks, embedding_model_instance)
+    vectordb = build_faiss_index_with_embedding(chunks, embedding_model_instance)
     return vectordb
 
 
@@ -122,6 +644,57 @@ def build_retriever(vectordb, search_type="mmr", k=5, lambda_mult=0.5):
         search_kwargs={"k": k, "lambda_mult": lambda_mult}
     )
 
+def mmr_select(query_vector, candidates, k, lambda_mult=0.5):
+    """
+    Greedy maximal marginal relevance over candidate vectors (cosine similarity).
+
+    Query and pairwise candidate similarities are computed up front with two
+    matrix products; each step then only updates a running max-redundancy vector.
+
+    Returns:
+        np.ndarray: indices into `candidates`, in selection order
+    """
+    k = min(k, len(candidates))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    candidates = candidates / np.maximum(np.linalg.norm(candidates, axis=1, keepdims=True), 1e-12)
+    query_vector = query_vector / max(np.linalg.norm(query_vector), 1e-12)
+    sim_q = candidates @ query_vector
+    sim_cc = candidates @ candidates.T
+    return _mmr_greedy(sim_q, sim_cc, k, lambda_mult).astype(np.int64)
+
+@njit(cache=True, fastmath=True)
+def _mmr_greedy(sim_q, sim_cc, k, lambda_mult):
+    """Greedy MMR selection loop, JIT-compiled (compiled once, cached on disk)"""
+    n = sim_q.shape[0]
+    selected = np.empty(k, dtype=np.int32)
+    picked = np.zeros(n, dtype=np.bool_)
+
+    best = 0
+    for i in range(1, n):
+        if sim_q[i] > sim_q[best]:
+            best = i
+    selected[0] = best
+    picked[best] = True
+    redundancy = sim_cc[best].copy()
+
+    for step in range(1, k):
+        best = -1
+        best_score = 0.0
+        for i in range(n):
+            if picked[i]:
+                continue
+            score = lambda_mult * sim_q[i] - (1 - lambda_mult) * redundancy[i]
+            if best == -1 or score > best_score:
+                best = i
+                best_score = score
+        selected[step] = best
+        picked[best] = True
+        for i in range(n):
+            if sim_cc[best, i] > redundancy[i]:
+                redundancy[i] = sim_cc[best, i]
+    return selected
+
 
 # -----------------------------
 # 6. RAG Pipeline Using Ollama
@@ -132,7 +705,7 @@ class RAGPipeline:
         self.model_name = model_name
         self.prompt_template = prompt_template
         self.embedding_model_name = embedding_model_name
-        self.embedding_model = HuggingFaceEmbeddings(model_name=embedding_model_name)
+        self.embedding_model = get_embedding_model(embedding_model_name)
         self.vectordb = None
         self.retriever = None
 
@@ -144,15 +717,76 @@ class RAGPipeline:
         self.retriever = build_retriever(self.vectordb)
 
     def retrieve_chunks(self, query: str, top_k: int = 5):
+        return self.retrieve_chunks_batch([query], top_k)[0]
+
+    def retrieve_chunks_batch(self, queries, top_k=5, fetch_k: int = 20,
+                              nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+        """
+        Retrieve chunks for several queries at once.
+
+        All queries are embedded in one call and searched with a single
+        FAISS search over the (B, d) query matrix; MMR reranking (if the
+        retriever uses it) is then applied per query.
+
+        Args:
+            queries: List of query strings
+            top_k: Number of chunks per query, or a list with one value per query
+                (capped at MAX_TOP_K)
+            fetch_k: MMR candidate pool size (raised to top_k when smaller)
+            nprobe: IVF lists to visit for this search (index default if None)
+            ef_search: HNSW search depth for this search (index default if None)
+        """
         if not self.retriever:
             raise ValueError("Retriever not initialized. Add documents first.")
-        return self.retriever.invoke(query)[:top_k]
-
-    def generate_answer(self, question: str, tone: str = "neutral", top_k: int = 5):
+        queries = list(queries)
+        top_ks = list(top_k) if isinstance(top_k, (list, tuple)) else [top_k] * len(queries)
+        top_ks = [min(k, MAX_TOP_K) for k in top_ks]
+        vectordb = self.vectordb
+        # Hold one reference: the session store may swap the index out while we search
+        index = vectordb.index
+        if index is None:
+            raise ValueError("Index not loaded.")
+        use_mmr = self.retriever.search_type == "mmr"
+        lambda_mult = self.retriever.search_kwargs.get("lambda_mult", 0.5)
+
+        # Each query gets the candidate count it would get if searched alone;
+        # the shared search fetches the largest and each query keeps its prefix
+        num_candidates = [max(fetch_k, k) if use_mmr else k for k in top_ks]
+        query_vectors = encode_texts(vectordb.embedding_function, queries, normalize=vectordb._normalize_L2)
+        params = search_parameters(index, nprobe=nprobe, ef_search=ef_search)
+        _, candidate_ids = index.search(query_vectors, max(num_candidates), params=params)
+
+        results = []
+        for query_vector, ids, k, n in zip(query_vectors, candidate_ids, top_ks, num_candidates):
+            ids = ids[:n]
+            ids = ids[ids != -1]
+            if use_mmr and len(ids) > 0:
+                candidates = index.reconstruct_batch(ids)
+                ids = ids[mmr_select(query_vector, candidates, k, lambda_mult)]
+            results.append([vectordb.docstore.search(vectordb.index_to_docstore_id[int(i)]) for i in ids[:k]])
+        return results
+
+    def generate_answer(self, question: str, tone: str = "neutral", top_k: int = 5, chunks=None):
         """
         Generate answer using Ollama + retrieved chunks + prompt template
+
+        Pass already retrieved `chunks` to skip retrieval.
         """
-        chunks = self.retrieve_chunks(question, top_k)
+        if chunks is None:
+            chunks = self.retrieve_chunks(question, top_k)
+        response = ollama.chat(model=self.model_name, messages=self._build_messages(question, tone, chunks))
+        return response["message"]["content"]
+
+    def generate_answer_stream(self, question: str, tone: str = "neutral", top_k: int = 5, chunks=None):
+        """
+        Same as generate_answer, but yields the answer in pieces as Ollama produces them
+        """
+        if chunks is None:
+            chunks = self.retrieve_chunks(question, top_k)
+        for part in ollama.chat(model=self.model_name, messages=self._build_messages(question, tone, chunks), stream=True):
+            yield part["message"]["content"]
+
+    def _build_messages(self, question: str, tone: str, chunks):
         context = "\n\n".join([c.page_content for c in chunks])
 
         # Fill template variables
@@ -166,9 +800,7 @@ class RAGPipeline:
             {"role": "system", "content": "Follow the user's custom prompt exactly."},
             {"role": "user", "content": prompt}
         ]
-
-        response = ollama.chat(model=self.model_name, messages=messages)
-        return response["message"]["content"]
+        return messages
 
 
 # -----------------------------